@@ -1,661 +1,799 @@
-"""
-Simple CLI utility which creates a GPX track file from a binary NMEA dump. 
-Dump must contain NMEA GGA messages and an initial RMG messsage to get the date.
-
-NOTE: input file has to be CRLF line terminated as that is the NMEA standard.
-
-EDITED by Philip Sargent to read date from GPRMC not just assume it is 'today'.
-renamed as nmeagpx.py
-but also see all these : https://duckduckgo.com/?q=nmea2gpx&atb=v316-1&ia=web
-
-
-https://github.com/semuconsulting/pynmeagps
-    Usage originally:
-    python3 gpxtracker.py infile="pygpsdata.log" outdir="."
-
-    There are a number of free online GPX viewers
-    e.g. https://gpx-viewer.com/view
-    Could have used minidom for XML but didn't seem worth it.
-    Created on 7 Mar 2021
-    @author: semuadmin
-"""
-
-import os, sys
-#import math
-from datetime import datetime, date, timezone, timedelta, time
-from pathlib import Path
-from sys import argv
-from time import strftime
-
-import pynmeagps.exceptions as nme
-from pynmeagps.nmeareader import NMEAReader
-from pynmeagps.nmeahelpers import planar, haversine
-
-M_PER_NM = 1852 # 1929 First International Extraordinary Hydrographic Conference in Monaco 
-
-JIGGLE = 3.4/5 # anything within this is considered the "same" point. This is the fifth-width of the boat
-STACK_MINUTES = 90 # how long we wait before flushing the stack
-MAXSTACK = 200 # maxium bumber of points to amalgamate even if they are very close
-MIDNIGHT = time(0, 0, 0, 0) # midnight
-NEAR_MIDNIGHT = time(0, 23, 59, 0) # one minute to midnight
-NEAR_DAYLENGTH = timedelta(hours=23) # nearly a whole day
-ONE_MINUTE = timedelta(minutes=1) 
-EIGHT_MINUTES = timedelta(minutes=8) 
-ONE_HOUR = timedelta(hours=1) 
-GLITCHES = []
-GAPS = []
-msg_stash = []
-
-XML_HDR = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
-
-GPX_NS = " ".join(
-    (
-        'xmlns="http://www.topografix.com/GPX/1/1"',
-        'creator="nmeagpx+pynmeagps" version="1.1"',
-        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"',
-        'xsi:schemaLocation="http://www.topografix.com/GPX/1/1',
-        'http://www.topografix.com/GPX/1/1/gpx.xsd"',
-    )
-)
-GITHUB_LINK = "https://github.com/semuconsulting/pynmeagps"
-
-stack_max = 0
-
-def tidy(dat):
-    # A datetime object wehere we don't care about the TZ as it is always UTC
-    return str(dat).replace('+00:00','')
-
-def is_in_time_period(startTime, endTime, check_time):
-    if startTime < endTime:
-        return startTime <= check_time <= endTime
-    else: #Over midnight
-        return check_time >= startTime or check_time <= endTime
-
-def time_diff(t1, t2):
-        # cant' different two time objects, only datetime objects
-        dateTime1 = datetime.combine(date.today(), t1)
-        dateTime2 = datetime.combine(date.today(), t2)
-        return dateTime1 - dateTime2
-        
-def strim(nmealat):
-    """Strims off the ..667 or ..333 at the end of the string
-    we do not need this pointless precision"""
-    st = str(nmealat)
-    if len(st) < 13:
-        return nmealat
-    
-    if st[10:] == "333":
-        st = st[:11]
-    if st[10:] == "667":
-        st = st[:10] + "7"
-    return float(st)
-
-def stash_msg(n,msg):
-    # don't process this msg, discard it. But keep a copy here for debugging
-    msg_stash.append((n,msg))
-    # print(f"-- STASH {n} {msg.msgID}  {msg.time}")
-
-def get_header(filename):
-    date = datetime.now(timezone.utc).replace(microsecond=0).isoformat() # not interested in fractions of a second
-    gpxtrack = (
-        XML_HDR + "\n<gpx " + GPX_NS + ">"
-        f"<metadata>"
-        f'<link href="{GITHUB_LINK}"><text>pynmeagps</text></link><time>{date}</time>'
-        "</metadata>\n"
-    )
-    return gpxtrack
-    
-def get_trkhdr(filename):
-    gpx = (f"<trk><name>GPX track from NMEA log {filename}</name>\n"
-        f" <trkseg>\n"
-        # f"<name>{filename}-SEG1</name>\n" # subfields are not legal for trkseg
-        )
-    return gpx
-
-def get_trkseg():
-    return f" </trkseg>\n <trkseg>\n"
-    
-def get_trktlr():
-    return " </trkseg>\n</trk>\n"
-
-def get_gpxtlr():
-    return "</gpx>"
-           
-class Stack:
-    """
-    A simple stack implementation with a maximum size.
-    We are using it to store NMEA sentences
-    
-    We want to empty the stack if the next reading is 
-    - out of range of the bounding box
-    - a long time after the box started, we want at least one reading an hour.
-    
-    We also have to manage the hdop value, ele, time and fix
-    """
-    def __init__(self, max_size):
-        self.max_size = max_size
-        self._items = []
-        self._box = BoundingBox()
-        self._first = None
-        self.full_count = 0
-        
-    def first(self):
-        return self._items[0]
-
-    def last(self):
-        return self._items[-1]
-        
-    def first_date(self):
-        msg, dat = self.first()
-        return dat
-
-    def is_empty(self):
-        return len(self._items) == 0
-
-    def is_full(self):
-        full = len(self._items) == self.max_size
-        if full:
-            self.full_count += 1
-            duration = self.duration() 
-            print(f"++ Stack full #{self.full_count}  box: {self.diameter():.1f} m  {duration} h:m:s from {self.first_date().strftime('%T %Z')}")        
-        return full
-
-    def pop(self):
-        m, d = self._items[-1]
-        return self._items.pop()
-
-    def push(self, msg_item):
-        msg, dat = msg_item
-        if self.is_full():
-            print("Stack Overflow! Cannot add item.", flush=True)
-        else:
-            if not self._first:
-               self._first = dat
-            self._box.update(msg.lat, msg.lon)
-            self._items.append(msg_item)
-
-    def it_fits(self, msg_item):
-        """There are many changes which mean that we should use the stack, write out the median, 
-        and flush"""
-        msg, dat = msg_item
-
-        if self.is_full():
-            last_item, last_dat = self._items[-1]
-            # print(f"STACK FULL Spread in stack:{last_dat - self._first}") # have seen 901
-            return False
-        if self.is_empty():
-            self.push(msg_item)
-            return True
-            
-        first_msg, _ = self._items[0]
-        if msg.quality != first_msg.quality:
-            print("QUALITY FIX change") # never happens!
-            return False
-            
-        since = dat - self._first
-        last_item, last_dat = self._items[-1]
-
-        if dat < last_dat:
-            # actually this is the clock running into the next day in TIME, but not changing the DATE, 
-            # because there hasn't been a midnight rollover to fix that
-            print(f"TIME TRAVEL: '{tidy(dat)}' < '{tidy(last_dat)}'\nGap:{dat - last_dat} h:m:s  Duration in [{len(self._items)}] stack:{last_dat - self._first} h:m:s")
-            print(f"{last_item}, {last_dat}")
-           
-        if since > timedelta(minutes=STACK_MINUTES):
-            # print(f"Gap detected:{dat - last_dat} h:m:s from {tidy(last_dat)} to {tidy(dat)}  Duration in [{len(self._items)}] stack:{last_dat - self._first} h:m:s ")
-            GAPS.append((f"from {tidy(last_dat)} to {tidy(dat)}  gap: {dat - last_dat} (duration in [{len(self._items)}] stack {last_dat - self._first})"))
-            return False
-        
-        # distance from centroid
-        centroid_lat, centroid_lon  = self._box.centroid()
-        distance = planar(centroid_lat, centroid_lon, msg.lat, msg.lon) # in metres
-        if distance > 50:
-            distance = haversine(centroid_lat, centroid_lon, msg.lat, msg.lon, radius = 6378137.0) # in metres
-        if distance > JIGGLE:
-            # print(f"JIGGLED {distance:.2f} m")
-            return False # i.e. too far away to be averaged in, so restart the stack
-        
-        self.push(msg_item)
-        return True
-
-    def flush(self):
-        global stack_max
-        if len(self._items) > stack_max:
-            stack_max =len(self._items)
-        self._items = []
-        self._first = None
-        # self.full_count = 0
-        self._box = BoundingBox()
-        
-    def centroid(self):
-        return self._box.centroid()
-
-    def diameter(self):
-        return self._box.diameter()
-
-    def duration(self):
-        # The length of time as a timedelta object between the first and last items in the stack
-        msg_first, dat_first = self.first()
-        msg_last, dat_last = self.last()
-        return dat_last - dat_first
-        
-    def median(self):
-        """Weighting lat & lon by hdop is tricky
-         We could use sum of squares average of hdop, but actually just picking the worst one is realistic"""
-        num = len(self._items)
-        # print("NUMBER", num)
-        lat = 0
-        lon = 0
-        alt = 0
-        hdop = 0
-        for msg_item in self._items:
-            i, dat = msg_item
-            alt += i.alt 
-            # should weight these averages by hdop I guess
-            lat += i.lat
-            lon += i.lon
-            if i.HDOP > hdop:
-                hdop = i.HDOP
-        first, _ = self._items[0]
-        quality = first.quality # use first one, they are all the same anyway
-        lat = float(f"{lat/num:.6f}")
-        lon = float(f"{lon/num:.6f}")
-        alt = float(f"{alt/num:.1f}")  # we have no basis for weighting altitudes, but they are garbage anyway
-        return lat, lon, alt, dat, quality, hdop
-
-class BoundingBox:
-    def __init__(self):
-        """ Constructor.  """
-        self._minlat = 90
-        self._maxlat = -90
-        self._minlon = 180
-        self._maxlon = 0
-
-    def update(self, lat, lon):
-        if lat > self._maxlat:
-            self._maxlat = lat
-        if lat < self._minlat:
-            self._minlat = lat
-
-        if lon > self._maxlon:
-            self._maxlon = lon
-        if lon < self._minlon:
-            self._minlon = lon
-    
-    def report(self):
-        return self._minlat, self._maxlat, self._minlon, self._maxlon
-        
-    def size(self):
-        return self._maxlat - self._minlat, self._maxlon - self._minlon
-
-    def centroid(self):
-        return (self._maxlat + self._minlat)/2, (self._maxlon + self._minlon)/2
-        
-    def diagonal_R(self):
-        return haversine(self._minlat, self._minlon, self._maxlat, self._maxlon, radius = 6378137.0)
-    def diagonal_L(self):
-        return haversine(self._minlat, self._maxlon, self._maxlat, self._minlon, radius = 6378137.0)
-        
-    def diameter(self):
-        return (self.diagonal_R() + self.diagonal_L())/2
-
-class NMEATracker:
-    """
-    NMEATracker class.
-    """
-
-    def __init__(self, infile, outdir, month_file_id):
-        """
-        Constructor.
-        """
-
-        self._filename = infile
-        self._outdir = outdir
-        self._infile = None
-        self._trkfname = None
-        self._trkfile = None
-        self._monthfile = month_file_id
-        self._nmeareader = None
-        self._connected = False
-        self._thisday = None
-        self._gpsstack = Stack(MAXSTACK)
-
-    def open(self):
-        """
-         Open datalog file."""
-        if not self._filename.is_file():
-            print("NOT A FILE")
-        else:
-            #print(f"opening {self._filename}")
-            pass
-        try:
-            self._infile = open(self._filename, "rb")
-            self._connected = True
-        except:
-            raise 
-
-    def close(self):
-        """
-        Close datalog file.
-        """
-        if self._connected and self._infile:
-            self._infile.close()
-
-    def restart_stack(self, msg_item):
-        # extract the whole stack, as averaged onto the median point,
-        # push the point onto a clean stack,
-        # then write out the median as a GPX point.
-        try:
-            lat, lon, alt, dat, quality, hdop = self._gpsstack.median()
-            
-          
-            datstr = dat.isoformat(sep="T",timespec='auto')
-            datstr = dat.strftime('%Y-%m-%dT%H:%M:%S') # no TZ as it must always be UTC
-            if quality == 1:
-                fix = "3d"
-            elif msg.quality == 2:
-                fix = "2d"
-            else:
-                fix = "none"
-             
-            self.write_gpx_trkpnt(
-                lat,
-                lon,
-                ele=alt,
-                time=datstr,
-                fix=fix,
-                hdop=hdop,
-            )
-        except IndexError:
-            # print(f".. Attempting to get median of empty stack {msg_item} ")
-            pass
-
-             
-        self._gpsstack.flush()
-        self._gpsstack.push(msg_item)
-      
-    def reader(self, month_filehandle, validate=False):
-        """
-        Reads and parses NMEA message data from stream
-        
-        We have a particular problem dealing with this common glitch
-        where the GGA time is out of synch with the RMC time
-        
-        $GPRMC,000001.00,A,3705.24783,N,02509.11117,E,0.168,,021024,,,A*79
-        $GPGGA,235958.00,3705.24796,N,02509.11108,E,1,11,0.77,15.7,M,32.0,M,,*66
-        $GPGGA,000005.00,3705.24776,N,02509.11127,E,1,11,0.77,16.5,M,32.0,M,,*61
-        """
-        bb = BoundingBox()
-
-        i = 0
-        n = 0
-        tp = 0
-        self._nmeareader = NMEAReader(self._infile, validate=validate)
-
-        self.write_gpx_hdr()
-        #print(self._nmeareader, self._infile)
-        prev_time = MIDNIGHT
-        first_GGA = True
-        for _, msg in self._nmeareader:  # invokes iterator method
-            n += 1
-            try:
-                d = msg.__dict__
-                if 'date' in d and d['date'] != "": # only RMC, but get it anywhere if it exists
-                   first_GGA = True # first GGA after any RMC
-                   # prev_time = msg.time # don't update, we do not use the time of the RMC msg
-                   if not self._thisday: # first line of file usually
-                        self._thisday = d['date']
-                        timestamp_updated = msg.time
-                        # print(f"++ First date seen '{d['date']}'  ({msg.msgID} line:{n:4} in {Path(self._infile.name).stem}")
-                   else: # later RMCs in the same day, caused by router re-start and concatenated files
-                        if self._thisday == d['date']:
-                            # ignore, same day
-                            # print(f"++ Same  date seen '{d['date']}'  ({msg.msgID} line:{n:4} in {Path(self._infile.name).stem}")
-                            timestamp_updated = msg.time
-                        else:
-                            # Use RMC to change to next day? but this is also done by the midnight rollover on GGA, so don't do this
-                            # as the rollover will immediately increment *again* on the next line
-                            prev = self._thisday  
-                            print(f"++ Different date  '{d['date']}' {msg.time} (was {prev}) {msg.msgID} line:{n:4} in {Path(self._infile.name).stem}")
-                            if d['date'] < prev:
-                                print(f"## Bad midnight rollover, RMC says we are still on previous day.")
-                       
-                    
-                
-                if msg.msgID == "GGA":
-                    #tim = msg.time
-                    if not self._thisday:
-                        # skip nmea lines until we get the date
-                        print(f"{Path(self._infile.name).stem} line:{n:6}:\n.. Skipping, no date.. {msg.time}. This should NOT happen.")
-                        stash_msg(n,msg)
-                        continue # ignore this msg and go on to next
-                    if first_GGA:
-                        # skip the first one as the timestamp is usually out of synch
-                        first_GGA = False
-                        if msg.time < prev_time:
-                            print(f".. BACKWD  Skip first GGA {msg.time} after RMC: {prev_time} {time_diff(prev_time, msg.time)} line:{n:4} {Path(self._infile.name).stem}")
-                            stash_msg(n,msg)
-                            continue # ignore this msg and go on to next
-                            
-                        if time_diff(msg.time, prev_time) > NEAR_DAYLENGTH:
-                            print(f".. FOREWD Skip first GGA {msg.time} after RMC: {prev_time} {time_diff(msg.time, prev_time)} line:{n:4} {Path(self._infile.name).stem}")
-                            stash_msg(n,msg)
-                            continue # ignore this msg and go on to next
-                        
-                    if msg.time < prev_time:
-                        if time_diff(prev_time, msg.time) < ONE_MINUTE:
-                            print(f" Backwards, but only by less than a minute, IGNORING {Path(self._infile.name).stem} line:{n:3}")
-                            stash_msg(n,msg)
-                            continue
-                        if time_diff(prev_time, msg.time) < EIGHT_MINUTES:
-                            print(f" Backwards, but by less than 8 minutes,     IGNORING {Path(self._infile.name).stem} line:{n:3}")
-                            stash_msg(n,msg)
-                            continue
-                        print(f"{Path(self._infile.name).stem} line:{n:6}:\n#### Time REVERSAL  from {prev_time} to {msg.time}\n (last RMC {timestamp_updated}) day: {self._thisday} ")
-                           
-                        # either bad data or midnight rollover
-                        # unfortunately we do see RMC datetime not quite the same as GGA, e.g.000001.00 on the line *before* 235956
-                        #   $GPRMC,000001.00,A,3706.41595,N,02652.43965,E,0.287,,060624,,,A*7A
-                        #   $GPGGA,235956.00,3706.41566,N,02652.43976,E,1,10,0.94,6.6,M,32.1,M,,*50
-                        # so the new date is set, but then immediately it appears that a midnight has occured.
-                        # solution: Detect if the time of the GGA is within 5 seconds of midnight, if so, ignore it.
-                        self._thisday += timedelta(days=1)
-                        d['date'] = self._thisday
-                        print(f"{Path(self._infile.name).stem} line:{n:6}:\n Midnight rollover  from {prev_time} to {msg.time}  (last RMC {timestamp_updated}) now: {self._thisday}")
-                        if False:
-                            # GLITCH handling not needed now that we refuse to store the first GGA msg after a RMC if it is suspect
-                            if is_in_time_period(prev_time, msg.time, timestamp_updated):
-                                if is_in_time_period(NEAR_MIDNIGHT, msg.time, MIDNIGHT):
-                                    # print(f"{Path(self._infile.name).stem} line:{n:6}:\n GLITCH near midnight {prev_time} to {msg.time}  (last done {timestamp_updated}) now: {self._thisday}")
-                                    GLITCHES.append((f"{Path(self._infile.name).stem} line:{n:4}", f"{prev_time}"))
-                                    self._gpsstack.pop() # delete the previous message in the stack as it is out of order
-                                    # Now re-set the 'prev' values to the previous item in the stack, ignoring the glitchy one
-                                    prev_time = MIDNIGHT
-                                else:
-                                    print(f"{Path(self._infile.name).stem} line:{n:4}:\n Midnight NOT rolledover {prev_time} to {msg.time}  (last done {timestamp_updated}) now: {self._thisday} ")
-                            
-
-                    dat = datetime.combine(self._thisday, msg.time, timezone.utc)
- 
-                    lat = strim(msg.lat)
-                    lon = strim(msg.lon)
-                    bb.update(lat, lon) # for the whole file, not just the stack
-
-                    msg_item = (msg, dat)
-                    if time_diff(msg.time, prev_time) > ONE_HOUR: 
-                        print(f".. Gap, start new <trkseg> {time_diff(msg.time, prev_time)} line:{n:4} {Path(self._infile.name).stem}")
-                        self.restart_stack(msg_item)
-                        self._trkfile.write(get_trkseg())
-                        month_filehandle.write(get_trkseg())
-                        tp += 1
-                    else:    
-                        if not self._gpsstack.it_fits(msg_item):
-                            self.restart_stack(msg_item)
-                            tp += 1
-                    prev_time = msg.time
-                    i += 1
-            except (nme.NMEAMessageError, nme.NMEATypeError, nme.NMEAParseError) as err:
-                print(f"Something went wrong {err}")
-                continue # get next msg
-
-        self.write_gpx_tlr()
-
-        print(f"{i:6d} GGA message{'' if i == 1 else 's'} -> {tp} trackpoints  {self._filename.name} -> {self._trkfname.name} box: {bb.diameter():.1f} m ~{bb.diameter()/M_PER_NM:6.2f} NM")
-        return bb
-
-    def write_gpx_hdr(self):
-        """
-        Open gpx file and write GPX track header tags
-        """
-        timestamp = strftime("%Y-%m-%d_%H%M%S")
-        self._trkfname = Path(self._outdir) / (Path(self._filename).stem + ".gpx")
-        self._trkfile = open(self._trkfname, "w", encoding="utf-8")
-
-        self._trkfile.write(get_header(self._filename))
-        self._trkfile.write(get_trkhdr(self._filename))
-
-        
-    def write_gpx_trkpnt(self, lat: float, lon: float, **kwargs):
-        """
-        Write GPX track point from NAV-PVT message content
-        """
-
-        trkpnt = f'  <trkpt lat="{lat}" lon="{lon}">'
-
-        # these are the permissible elements in the GPX schema for wptType
-        # http://www.topografix.com/GPX/1/1/#type_wptType
-        for tag in (
-            "ele",
-            "time",
-            "magvar",
-            "geoidheight",
-            "name",
-            "cmt",
-            "desc",
-            "src",
-            "link",
-            "sym",
-            "type",
-            "fix",
-            "sat",
-            "hdop",
-            "vdop",
-            "pdop",
-            "ageofdgpsdata",
-            "dgpsid",
-            "extensions",
-        ):
-            if tag in kwargs:
-                val = kwargs[tag]
-                trkpnt += f"<{tag}>{val}</{tag}>"
-
-        trkpnt += "</trkpt>\n"
-
-        self._trkfile.write(trkpnt)
-        self._monthfile.write(trkpnt)
-
-    def write_gpx_tlr(self):
-        """
-        Write GPX track trailer tags and close file
-        """    
-        self._trkfile.write(get_trktlr())
-        self._trkfile.write(get_gpxtlr())
-        self._trkfile.close()
-
-
-def main(indir, midsuffix, insuffix):
-    """
-    Main routine.
-    """
-    global stack_max
-    global msg_stash
-    global month_gpx
-
-    indir = Path(indir)
-    if not indir.is_dir():
-        print(f"Directory does not exist: '{INDIR}")
-        sys.exit(1)    
-
-    outdir = indir
-    print(f"NMEA datalog to GPX file converter ('{insuffix}' files in {indir})")
-
-    filepaths = sorted(indir.iterdir(), key=lambda p: p.name.lower())
-    
-    # Create the list of files to be processed in the order we want
-    trips = []
-    infiles = []
-    for filepath in filepaths:
-        if filepath.suffix == insuffix:
-            if Path(filepath.stem).suffix == midsuffix:
-                infiles.append(filepath)
-    print(f"{len(infiles)} {midsuffix}{insuffix} files to convert to GPX")
-    
-    month_gpx = f"{indir}.mnth.gpx"
-    month_file = Path(indir) / month_gpx
-    print(f"Consolidate into {month_file}")
-    with open(month_file, "w", encoding="utf-8") as mnf: 
-        mnf.write(get_header(f"{indir}/"))
-        
-        # Process the files and do calculations
-        for i in infiles:
-            #print(f" in", i.name)
-            msg_stash = []
-            inpath = indir / i
-            
-            mnf.write(get_trkhdr(inpath))
-
-            tkr = NMEATracker(inpath, outdir, mnf)
-            tkr.open()
-            bound_box = tkr.reader(mnf)
-            tkr.close()
-            mnf.write(get_trktlr())
-            
-            if bound_box.diameter() > 0.1 * M_PER_NM : # 0.1 NM in metres
-                trips.append((i.name, bound_box.diameter(),bound_box.diagonal_R(),bound_box.diagonal_L(),len(msg_stash)))
-                
-            if msg_stash:
-                print(f"{len(msg_stash)} discarded NMEA sentences")
-                for n, m in msg_stash:
-                    # print(n, m)    
-                    pass
-            print("")
-            
-        mnf.write(get_gpxtlr())
- 
-    if GLITCHES:
-        print(f"{len(GLITCHES)} glitches:")
-        for g in GLITCHES:
-            fn, gtext = g
-            print(f"{fn} {gtext}")
-    if GAPS:
-        print(f"{len(GAPS)} gaps:")
-        for g in GAPS:
-            print(g)
-            
-
-            
-    # Print summary data in 'trips' for each file (i.e. each day) 
-    for t in trips:
-        name, diam, diag_R, diag_L, n_stash = t
-        print(f"{name} box: ~{diam/M_PER_NM:5.1f} NM {n_stash} discards") 
-    print(f"Finished all files, max stack used: {stack_max}")
-    
-
-
-
-if __name__ == "__main__":
-
-    INDIR = "/home/philip/gps/nmea_data/2024-06/"
-    MIDSUFFIX = ".day" # i.e. ".day.nmea"
-    INSUFFIX = ".nmea"
-    
-    if len(sys.argv) == 4:
-        INDIR = sys.argv[1]
-        MIDSUFFIX = sys.argv[2]
-        INSUFFIX = sys.argv[3]
-
-
-    if len(sys.argv) >4:
-        print(f"Either with no parameters or with nmea directory & suffix & midsuffix e.g.\n$ python nmeagpx.py /home/philip/gps/nmea_data/2024-05/ '.day' '.nmea'", flush=True)
-
-    main(INDIR, MIDSUFFIX, INSUFFIX)
+"""
+Simple CLI utility which creates a GPX track file from a binary NMEA dump. 
+Dump must contain NMEA GGA messages and an initial RMG messsage to get the date.
+
+NOTE: input file has to be CRLF line terminated as that is the NMEA standard.
+
+EDITED by Philip Sargent to read date from GPRMC not just assume it is 'today'.
+renamed as nmeagpx.py
+but also see all these : https://duckduckgo.com/?q=nmea2gpx&atb=v316-1&ia=web
+
+
+https://github.com/semuconsulting/pynmeagps
+    Usage originally:
+    python3 gpxtracker.py infile="pygpsdata.log" outdir="."
+
+    There are a number of free online GPX viewers
+    e.g. https://gpx-viewer.com/view
+    Could have used minidom for XML but didn't seem worth it.
+    Created on 7 Mar 2021
+    @author: semuadmin
+"""
+
+import os, sys
+#import math
+import mmap
+from array import array
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timezone, timedelta, time
+from pathlib import Path
+from statistics import median
+from sys import argv
+from time import strftime
+from xml.sax.saxutils import escape
+
+import pynmeagps.exceptions as nme
+from math import acos, cos, pi
+from pynmeagps.nmeareader import NMEAReader
+from pynmeagps.nmeahelpers import haversine
+
+M_PER_NM = 1852 # 1929 First International Extraordinary Hydrographic Conference in Monaco
+
+JIGGLE = 3.4/5 # anything within this is considered the "same" point. This is the fifth-width of the boat
+JIGGLE2 = JIGGLE * JIGGLE # squared, so we can compare squared distances without a sqrt
+JIGGLE_BOX2 = 4 * JIGGLE2 # squared full diagonal of a box whose half-diagonal is JIGGLE
+CELL_DEG = JIGGLE / (pi * 6378137.0 / 180) # JIGGLE-sized grid cell, in degrees of latitude
+DEG2M = pi * 6378137.0 / 180 # metres per degree of latitude (WGS84 semi-major axis)
+STACK_MINUTES = 90 # how long we wait before flushing the stack
+STACK_LIMIT_S = STACK_MINUTES * 60 # the same, in seconds, for epoch-seconds arithmetic
+MAXSTACK = 200 # maxium bumber of points to amalgamate even if they are very close
+MIDNIGHT = time(0, 0, 0, 0) # midnight
+NEAR_MIDNIGHT = time(0, 23, 59, 0) # one minute to midnight
+NEAR_DAYLENGTH_S = 23 * 3600 # nearly a whole day, in seconds
+ONE_MINUTE_S = 60
+EIGHT_MINUTES_S = 8 * 60
+ONE_HOUR_S = 3600
+
+XML_HDR = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+
+GPX_NS = " ".join(
+    (
+        'xmlns="http://www.topografix.com/GPX/1/1"',
+        'creator="nmeagpx+pynmeagps" version="1.1"',
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"',
+        'xsi:schemaLocation="http://www.topografix.com/GPX/1/1',
+        'http://www.topografix.com/GPX/1/1/gpx.xsd"',
+    )
+)
+GITHUB_LINK = "https://github.com/semuconsulting/pynmeagps"
+
+# the constant part of the header, concatenated once at module load
+GPX_HDR_PREFIX = XML_HDR + "\n<gpx " + GPX_NS + ">"
+
+# the permissible elements in the GPX schema for wptType
+# http://www.topografix.com/GPX/1/1/#type_wptType
+GPX_WPT_TAGS = frozenset((
+    "ele",
+    "time",
+    "magvar",
+    "geoidheight",
+    "name",
+    "cmt",
+    "desc",
+    "src",
+    "link",
+    "sym",
+    "type",
+    "fix",
+    "sat",
+    "hdop",
+    "vdop",
+    "pdop",
+    "ageofdgpsdata",
+    "dgpsid",
+    "extensions",
+))
+
+# precompiled template for the trackpoint shape this tool actually writes;
+# %-formatting into one constant string beats assembling per-tag f-strings
+TRKPNT_TMPL = ('  <trkpt lat="%s" lon="%s"><ele>%s</ele><time>%s</time>'
+               '<fix>%s</fix><hdop>%s</hdop></trkpt>\n')
+TRKPNT_TAGS = {"ele", "time", "fix", "hdop"}
+
+# per-process buffer pool: successive convert_file calls in the same worker
+# reuse these lists (which keep their allocated capacity) instead of growing
+# fresh ones from empty for every file. Only one NMEATracker runs per process.
+_trkbuf_pool = []
+_mnbuf_pool = []
+
+def tidy(dat):
+    # A datetime object wehere we don't care about the TZ as it is always UTC
+    return str(dat).removesuffix('+00:00') # the TZ can only be at the end
+
+def tidy_s(dat_s):
+    # as tidy(), but from epoch seconds (the hot loop never builds datetime objects)
+    return tidy(datetime.fromtimestamp(dat_s, timezone.utc))
+
+def is_in_time_period(startTime, endTime, check_time):
+    if startTime < endTime:
+        return startTime <= check_time <= endTime
+    else: #Over midnight
+        return check_time >= startTime or check_time <= endTime
+
+def strim(nmealat):
+    """Rounds off the ..6667 or ..3333 recurring decimals at the end of the value
+    we do not need this pointless precision. Pure arithmetic, no str/float round-trip."""
+    try:
+        return round(nmealat, 7) # 7 decimal places is ~1 cm of latitude
+    except TypeError: # not a number, e.g. an empty field
+        return nmealat
+
+def get_header(filename):
+    date = datetime.now(timezone.utc).replace(microsecond=0).isoformat() # not interested in fractions of a second
+    gpxtrack = (
+        GPX_HDR_PREFIX
+        + f"<metadata>"
+        f'<link href="{GITHUB_LINK}"><text>pynmeagps</text></link><time>{date}</time>'
+        "</metadata>\n"
+    )
+    return gpxtrack
+    
+def get_trkhdr(filename):
+    # the filename is the only free text that enters the XML, so escape it;
+    # everything else we emit is generated, which is why hand-rolled strings
+    # (rather than an XML library) are safe as well as fast here
+    gpx = (f"<trk><name>GPX track from NMEA log {escape(str(filename))}</name>\n"
+        f" <trkseg>\n"
+        # f"<name>{filename}-SEG1</name>\n" # subfields are not legal for trkseg
+        )
+    return gpx
+
+def get_trkseg():
+    return f" </trkseg>\n <trkseg>\n"
+    
+def get_trktlr():
+    return " </trkseg>\n</trk>\n"
+
+def get_gpxtlr():
+    return "</gpx>"
+           
+class Stack:
+    """
+    A simple stack implementation with a maximum size.
+    We are using it to store NMEA sentences
+    
+    We want to empty the stack if the next reading is 
+    - out of range of the bounding box
+    - a long time after the box started, we want at least one reading an hour.
+    
+    We also have to manage the hdop value, ele, time and fix
+
+    Storage is struct-of-arrays: preallocated flat double arrays for
+    lat/lon/alt/HDOP plus a parallel list of datetimes, with a fill index.
+    median() then sums contiguous C doubles instead of chasing attribute
+    lookups through a list of message objects.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lat = array("d", bytes(8 * max_size))
+        self._lon = array("d", bytes(8 * max_size))
+        self._alt = array("d", bytes(8 * max_size))
+        self._hdop = array("d", bytes(8 * max_size))
+        self._dats = array("d", bytes(8 * max_size)) # epoch seconds, same fixed slots as the other arrays
+        self._n = 0
+        self._quality = None
+        self._last_msg = None # only kept for diagnostics
+        self._box = BoundingBox()
+        self._first = None
+        self._cell = None # grid cell of the first fix, for the spatial-hash fast path
+        self._cell_pure = False # True while every fix so far shares that cell
+        self.full_count = 0
+        self.gaps = [] # instance state, not module globals: keeps workers independent
+        self.used_max = 0 # deepest fill reached over the life of this stack
+
+    def first_date(self):
+        return datetime.fromtimestamp(self._dats[0], timezone.utc)
+
+    def is_empty(self):
+        return self._n == 0
+
+    def is_full(self):
+        # pure predicate, no side effects: it_fits owns the "stack full"
+        # diagnostic at the point where fullness actually forces a flush
+        return self._n == self.max_size
+
+    def pop(self):
+        self._n -= 1
+        return self._dats[self._n]
+
+    def push(self, msg, dat):
+        if self._n == self.max_size:
+            print("Stack Overflow! Cannot add item.", flush=True)
+        else:
+            if not self._first:
+               self._first = dat
+            self._box.update(msg.lat, msg.lon)
+            n = self._n
+            self._lat[n] = msg.lat
+            self._lon[n] = msg.lon
+            self._alt[n] = msg.alt
+            self._hdop[n] = msg.HDOP
+            self._dats[n] = dat
+            if self._quality is None:
+                self._quality = msg.quality
+            cell = (msg.lat // CELL_DEG, msg.lon // CELL_DEG)
+            if n == 0:
+                self._cell = cell
+                self._cell_pure = True
+            elif self._cell_pure and cell != self._cell:
+                self._cell_pure = False
+            self._last_msg = msg
+            self._n = n + 1
+
+    def it_fits(self, msg, dat):
+        """There are many changes which mean that we should use the stack, write out the median,
+        and flush"""
+        if self._n == self.max_size:
+            # print(f"STACK FULL Spread in stack:{self._dats[-1] - self._first}") # have seen 901
+            self.full_count += 1
+            print(f"++ Stack full #{self.full_count}  box: {self.diameter():.1f} m  {self.duration()} h:m:s from {self.first_date().strftime('%T %Z')}")
+            return False
+        if self.is_empty():
+            self.push(msg, dat)
+            return True
+
+        if msg.quality != self._quality:
+            print("QUALITY FIX change") # never happens!
+            return False
+
+        since = dat - self._first
+        last_item = self._last_msg
+        last_dat = self._dats[self._n - 1]
+
+        if dat < last_dat:
+            # actually this is the clock running into the next day in TIME, but not changing the DATE,
+            # because there hasn't been a midnight rollover to fix that
+            print(f"TIME TRAVEL: '{tidy_s(dat)}' < '{tidy_s(last_dat)}'\nGap:{timedelta(seconds=dat - last_dat)} h:m:s  Duration in [{self._n}] stack:{timedelta(seconds=last_dat - self._first)} h:m:s")
+            print(f"{last_item}, {tidy_s(last_dat)}")
+
+        if since > STACK_LIMIT_S:
+            # print(f"Gap detected:{timedelta(seconds=dat - last_dat)} h:m:s from {tidy_s(last_dat)} to {tidy_s(dat)}")
+            self.gaps.append((f"from {tidy_s(last_dat)} to {tidy_s(dat)}  gap: {timedelta(seconds=dat - last_dat)} (duration in [{self._n}] stack {timedelta(seconds=last_dat - self._first)})"))
+            return False
+        
+        # spatial-hash fast path: while every fix so far sits in the same
+        # JIGGLE-sized grid cell, a new fix in that cell keeps the box inside
+        # the cell, whose diagonal is under the JIGGLE_BOX2 limit - so accept
+        # on two floor-divisions and skip the box arithmetic. A fix in a
+        # neighbouring cell is NOT a rejection; the exact test below decides.
+        if self._cell_pure and (msg.lat // CELL_DEG, msg.lon // CELL_DEG) == self._cell:
+            self.push(msg, dat)
+            return True
+
+        # pure bounding-box test, like a geo pre-filter: if the box grown to take
+        # this fix would still be JIGGLE-sized (half-diagonal within JIGGLE), it fits.
+        # No centroid distance, no sqrt; anything further is certainly not the "same" point.
+        if self._box.extent2_with(msg.lat, msg.lon) > JIGGLE_BOX2:
+            # print(f"JIGGLED")
+            return False # i.e. too far away to be averaged in, so restart the stack
+        
+        self.push(msg, dat)
+        return True
+
+    def flush(self):
+        if self._n > self.used_max:
+            self.used_max = self._n
+        self._n = 0 # the flat arrays and date slots are reused, not reallocated
+        self._quality = None
+        self._last_msg = None
+        self._first = None
+        self._cell = None
+        self._cell_pure = False
+        # self.full_count = 0
+        self._box = BoundingBox()
+
+    def centroid(self):
+        return self._box.centroid()
+
+    def diameter(self):
+        return self._box.diameter()
+
+    def duration(self):
+        # The length of time as a timedelta object between the first and last items in the stack
+        return timedelta(seconds=self._dats[self._n - 1] - self._dats[0])
+
+    def median(self):
+        """Now a true per-axis median, so a single glitchy fix cannot drag the point.
+        Weighting lat & lon by hdop is tricky
+         We could use sum of squares average of hdop, but actually just picking the worst one is realistic"""
+        num = self._n
+        if num == 0:
+            raise IndexError("median of an empty stack")
+        dat = datetime.fromtimestamp(self._dats[num - 1], timezone.utc)
+        lat = round(median(self._lat[:num]), 6)
+        lon = round(median(self._lon[:num]), 6)
+        alt = round(median(self._alt[:num]), 1)  # we have no basis for weighting altitudes, but they are garbage anyway
+        hdop = max(self._hdop[:num])
+        quality = self._quality # use first one, they are all the same anyway
+        return lat, lon, alt, dat, quality, hdop
+
+class BoundingBox:
+    # fixed attribute slots: a new box is made on every stack flush, and slots
+    # make those instances smaller and their attribute access a little faster
+    __slots__ = ("_minlat", "_maxlat", "_minlon", "_maxlon", "_clat", "_clon", "_coslat")
+
+    def __init__(self):
+        """ Constructor.  """
+        self._minlat = 90
+        self._maxlat = -90
+        self._minlon = 180
+        self._maxlon = 0
+        # centroid of the (empty) box, cached so the hot it_fits loop gets it for free
+        self._clat = 0.0
+        self._clon = 90.0
+        self._coslat = 1.0 # cos of the centroid latitude, refreshed on update()
+
+    def update(self, lat, lon):
+        # min()/max() builtins rather than four data-dependent branches
+        self._minlat = min(self._minlat, lat)
+        self._maxlat = max(self._maxlat, lat)
+        self._minlon = min(self._minlon, lon)
+        self._maxlon = max(self._maxlon, lon)
+        self._clat = (self._maxlat + self._minlat)/2
+        self._clon = (self._maxlon + self._minlon)/2
+        self._coslat = cos(self._clat)
+
+    def report(self):
+        return self._minlat, self._maxlat, self._minlon, self._maxlon
+
+    def size(self):
+        return self._maxlat - self._minlat, self._maxlon - self._minlon
+
+    def centroid(self):
+        return self._clat, self._clon
+
+    def extent2_with(self, lat, lon):
+        """Squared diagonal in metres of this box as it would be if grown to include (lat, lon).
+        Same arithmetic as nmeahelpers.planar, including its cos-of-the-latitude-as-given."""
+        dlat = (max(self._maxlat, lat) - min(self._minlat, lat)) * DEG2M
+        dlon = (max(self._maxlon, lon) - min(self._minlon, lon)) * self._coslat * DEG2M
+        return dlat * dlat + dlon * dlon
+
+    def diagonal_R(self):
+        return haversine(self._minlat, self._minlon, self._maxlat, self._maxlon, radius = 6378137.0)
+    def diagonal_L(self):
+        return haversine(self._minlat, self._maxlon, self._maxlat, self._minlon, radius = 6378137.0)
+        
+    def diameter(self):
+        # The two diagonals share every trig term - cos is even, so
+        # cos(maxlon-minlon) == cos(minlon-maxlon) and diagonal_R == diagonal_L
+        # identically. Evaluate the shared haversine expression just once
+        # instead of averaging two calls that compute the same number.
+        rad = pi / 180
+        phi1 = self._minlat * rad
+        phi2 = self._maxlat * rad
+        dlam = (self._maxlon - self._minlon) * rad
+        return 6378137.0 * acos(cos(phi2 - phi1) - cos(phi1) * cos(phi2) * (1 - cos(dlam)))
+
+class NMEATracker:
+    """
+    NMEATracker class.
+    """
+
+    def __init__(self, infile, outdir):
+        """
+        Constructor.
+        """
+
+        self._filename = infile
+        self._outdir = outdir
+        self._infile = None
+        self._trkfname = None
+        self._trkfile = None
+        self._nmeareader = None
+        self._connected = False
+        self._thisday = None
+        self._gpsstack = Stack(MAXSTACK)
+        # output is accumulated in these and written in one go, not per-trackpoint
+        self._trkbuf = _trkbuf_pool
+        self._trkbuf.clear()
+        self._mnbuf = _mnbuf_pool
+        self._mnbuf.clear()
+        self._stash = [] # discarded (n, msg) sentences, kept for debugging
+        self._glitches = []
+
+    def open(self):
+        """
+         Open datalog file."""
+        if not self._filename.is_file():
+            print("NOT A FILE")
+        else:
+            #print(f"opening {self._filename}")
+            pass
+        try:
+            # Memory-map the day file and pre-filter it in place: only GGA
+            # and RMC sentences are dispatched, and mmap.find is a C-level
+            # scan over the page cache, so the GSV/GSA/VTG majority is
+            # skipped without ever being copied, checksummed or parsed.
+            # NMEAReader then scans the retained lines from a BytesIO,
+            # avoiding the buffered-io layer entirely. Note the line numbers
+            # in diagnostics count retained sentences only.
+            wanted = []
+            with open(self._filename, "rb") as f:
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        size = len(mm)
+                        find = mm.find
+                        pos = 0
+                        while pos < size:
+                            nl = find(b"\n", pos)
+                            end = size if nl < 0 else nl + 1
+                            if (find(b"GGA,", pos, end) >= 0
+                                    or find(b"RMC,", pos, end) >= 0):
+                                wanted.append(mm[pos:end])
+                            pos = end
+                except ValueError: # a zero-length file cannot be mapped
+                    pass
+            self._infile = BytesIO(b"".join(wanted))
+            self._infile.name = str(self._filename)  # diagnostics print the stem
+            self._connected = True
+        except:
+            raise
+
+    def close(self):
+        """
+        Close datalog file.
+        """
+        if self._connected and self._infile:
+            self._infile.close()
+
+    def restart_stack(self, msg, dat):
+        # extract the whole stack, as averaged onto the median point,
+        # push the point onto a clean stack,
+        # then write out the median as a GPX point.
+        try:
+            lat, lon, alt, mdat, quality, hdop = self._gpsstack.median()
+
+
+            datstr = mdat.strftime('%Y-%m-%dT%H:%M:%S') # no TZ as it must always be UTC
+            if quality == 1:
+                fix = "3d"
+            elif quality == 2:
+                fix = "2d"
+            else:
+                fix = "none"
+             
+            self.write_gpx_trkpnt(
+                lat,
+                lon,
+                ele=alt,
+                time=datstr,
+                fix=fix,
+                hdop=hdop,
+            )
+        except IndexError:
+            # print(f".. Attempting to get median of empty stack ")
+            pass
+
+             
+        self._gpsstack.flush()
+        self._gpsstack.push(msg, dat)
+      
+    def reader(self, validate=False):
+        """
+        Reads and parses NMEA message data from stream
+        
+        We have a particular problem dealing with this common glitch
+        where the GGA time is out of synch with the RMC time
+        
+        $GPRMC,000001.00,A,3705.24783,N,02509.11117,E,0.168,,021024,,,A*79
+        $GPGGA,235958.00,3705.24796,N,02509.11108,E,1,11,0.77,15.7,M,32.0,M,,*66
+        $GPGGA,000005.00,3705.24776,N,02509.11127,E,1,11,0.77,16.5,M,32.0,M,,*61
+        """
+        bb = BoundingBox()
+
+        i = 0
+        n = 0
+        tp = 0
+        # bind the hot callables to locals once; dodges the attribute/global
+        # lookups that CPython would otherwise repeat for every sentence
+        it_fits = self._gpsstack.it_fits
+        stash = self._stash.append # don't process this msg, just keep a copy for debugging
+        stem = Path(self._infile.name).stem # hoisted: every diagnostic below uses it
+        bb_update = bb.update
+        combine = datetime.combine
+        utc = timezone.utc
+        self._nmeareader = NMEAReader(self._infile, validate=validate)
+
+        self.write_gpx_hdr()
+        #print(self._nmeareader, self._infile)
+        prev_time = MIDNIGHT
+        prev_tsec = 0.0 # prev_time as float seconds-of-day, for the hot comparisons
+        first_GGA = True
+        day_start_s = 0.0 # epoch seconds of midnight UTC on self._thisday
+        timestamp_updated = MIDNIGHT
+
+        def do_rmc(msg):
+            # the RMC sentence carries the date; everything else only has a time
+            nonlocal first_GGA, day_start_s, timestamp_updated
+            msgdate = getattr(msg, 'date', "")
+            if msgdate == "": # sometimes corrupted, but with a valid checksum
+                return
+            first_GGA = True # first GGA after any RMC
+            # prev_time = msg.time # don't update, we do not use the time of the RMC msg
+            if not self._thisday: # first line of file usually
+                self._thisday = msgdate
+                day_start_s = combine(self._thisday, MIDNIGHT, utc).timestamp()
+                timestamp_updated = msg.time
+                # print(f"++ First date seen '{msgdate}'  ({msg.msgID} line:{n:4} in {stem}")
+            else: # later RMCs in the same day, caused by router re-start and concatenated files
+                if self._thisday == msgdate:
+                    # ignore, same day
+                    # print(f"++ Same  date seen '{msgdate}'  ({msg.msgID} line:{n:4} in {stem}")
+                    timestamp_updated = msg.time
+                else:
+                    # Use RMC to change to next day? but this is also done by the midnight rollover on GGA, so don't do this
+                    # as the rollover will immediately increment *again* on the next line
+                    prev = self._thisday
+                    print(f"++ Different date  '{msgdate}' {msg.time} (was {prev}) {msg.msgID} line:{n:4} in {stem}")
+                    if msgdate < prev:
+                        print(f"## Bad midnight rollover, RMC says we are still on previous day.")
+
+        def do_gga(msg):
+            nonlocal first_GGA, prev_time, prev_tsec, day_start_s, i, tp
+            # cache the hot attributes once on first inspection, and keep the
+            # timestamp as float seconds-of-day: every comparison below is then
+            # plain arithmetic rather than datetime.time rich comparison
+            t = msg.time
+            tsec = t.hour * 3600 + t.minute * 60 + t.second + t.microsecond * 1e-6
+            if not self._thisday:
+                # skip nmea lines until we get the date
+                print(f"{stem} line:{n:6}:\n.. Skipping, no date.. {t}. This should NOT happen.")
+                stash((n, msg))
+                return # ignore this msg and go on to next
+            if first_GGA:
+                # skip the first one as the timestamp is usually out of synch
+                first_GGA = False
+                if tsec < prev_tsec:
+                    print(f".. BACKWD  Skip first GGA {t} after RMC: {prev_time} {timedelta(seconds=prev_tsec - tsec)} line:{n:4} {stem}")
+                    stash((n, msg))
+                    return # ignore this msg and go on to next
+
+                if tsec - prev_tsec > NEAR_DAYLENGTH_S:
+                    print(f".. FOREWD Skip first GGA {t} after RMC: {prev_time} {timedelta(seconds=tsec - prev_tsec)} line:{n:4} {stem}")
+                    stash((n, msg))
+                    return # ignore this msg and go on to next
+
+            if tsec < prev_tsec:
+                if prev_tsec - tsec < ONE_MINUTE_S:
+                    print(f" Backwards, but only by less than a minute, IGNORING {stem} line:{n:3}")
+                    stash((n, msg))
+                    return
+                if prev_tsec - tsec < EIGHT_MINUTES_S:
+                    print(f" Backwards, but by less than 8 minutes,     IGNORING {stem} line:{n:3}")
+                    stash((n, msg))
+                    return
+                print(f"{stem} line:{n:6}:\n#### Time REVERSAL  from {prev_time} to {t}\n (last RMC {timestamp_updated}) day: {self._thisday} ")
+                   
+                # either bad data or midnight rollover
+                # unfortunately we do see RMC datetime not quite the same as GGA, e.g.000001.00 on the line *before* 235956
+                #   $GPRMC,000001.00,A,3706.41595,N,02652.43965,E,0.287,,060624,,,A*7A
+                #   $GPGGA,235956.00,3706.41566,N,02652.43976,E,1,10,0.94,6.6,M,32.1,M,,*50
+                # so the new date is set, but then immediately it appears that a midnight has occured.
+                # solution: Detect if the time of the GGA is within 5 seconds of midnight, if so, ignore it.
+                self._thisday += timedelta(days=1)
+                day_start_s += 86400.0
+                msg.__dict__['date'] = self._thisday # poke past NMEAMessage immutability, as before
+                print(f"{stem} line:{n:6}:\n Midnight rollover  from {prev_time} to {t}  (last RMC {timestamp_updated}) now: {self._thisday}")
+                if False:
+                    # GLITCH handling not needed now that we refuse to store the first GGA msg after a RMC if it is suspect
+                    if is_in_time_period(prev_time, t, timestamp_updated):
+                        if is_in_time_period(NEAR_MIDNIGHT, t, MIDNIGHT):
+                            # print(f"{stem} line:{n:6}:\n GLITCH near midnight {prev_time} to {t}  (last done {timestamp_updated}) now: {self._thisday}")
+                            self._glitches.append((f"{stem} line:{n:4}", f"{prev_time}"))
+                            self._gpsstack.pop() # delete the previous message in the stack as it is out of order
+                            # Now re-set the 'prev' values to the previous item in the stack, ignoring the glitchy one
+                            prev_time = MIDNIGHT
+                        else:
+                            print(f"{stem} line:{n:4}:\n Midnight NOT rolledover {prev_time} to {t}  (last done {timestamp_updated}) now: {self._thisday} ")
+                    
+
+            # seconds since the epoch, by arithmetic: no datetime.combine per point
+            dat = day_start_s + tsec
+
+            lat = strim(msg.lat)
+            lon = strim(msg.lon)
+            bb_update(lat, lon) # for the whole file, not just the stack
+
+            if tsec - prev_tsec > ONE_HOUR_S:
+                print(f".. Gap, start new <trkseg> {timedelta(seconds=tsec - prev_tsec)} line:{n:4} {stem}")
+                self.restart_stack(msg, dat)
+                self._trkbuf.append(get_trkseg())
+                self._mnbuf.append(get_trkseg())
+                tp += 1
+            else:
+                if not it_fits(msg, dat):
+                    self.restart_stack(msg, dat)
+                    tp += 1
+            prev_time = t
+            prev_tsec = tsec
+            i += 1
+
+        dispatch = {"RMC": do_rmc, "GGA": do_gga} # precompiled: msgID -> handler function
+        for _, msg in self._nmeareader:  # invokes iterator method
+            n += 1
+            handler = dispatch.get(msg.msgID)
+            if handler is None:
+                continue # GSA/GSV/VTG etc carry nothing we use
+            try:
+                handler(msg)
+            except (nme.NMEAMessageError, nme.NMEATypeError, nme.NMEAParseError) as err:
+                print(f"Something went wrong {err}")
+                continue # get next msg
+
+
+        self.write_gpx_tlr()
+
+        print(f"{i:6d} GGA message{'' if i == 1 else 's'} -> {tp} trackpoints  {self._filename.name} -> {self._trkfname.name} box: {bb.diameter():.1f} m ~{bb.diameter()/M_PER_NM:6.2f} NM")
+        return bb
+
+    def month_fragment(self):
+        """
+        This file's contribution to the consolidated month GPX file, as one string
+        """
+        return "".join(self._mnbuf)
+
+    def write_gpx_hdr(self):
+        """
+        Open gpx file and write GPX track header tags
+        """
+        timestamp = strftime("%Y-%m-%d_%H%M%S")
+        self._trkfname = Path(self._outdir) / (Path(self._filename).stem + ".gpx")
+        self._trkfile = open(self._trkfname, "w", encoding="utf-8")
+
+        self._trkbuf.append(get_header(self._filename))
+        self._trkbuf.append(get_trkhdr(self._filename))
+
+        
+    def write_gpx_trkpnt(self, lat: float, lon: float, **kwargs):
+        """
+        Write GPX track point from NAV-PVT message content
+        """
+
+        if kwargs.keys() == TRKPNT_TAGS:
+            # the shape restart_stack always writes: one template substitution
+            trkpnt = TRKPNT_TMPL % (lat, lon, kwargs["ele"], kwargs["time"],
+                                    kwargs["fix"], kwargs["hdop"])
+        else:
+            # iterate only the tags actually supplied (callers pass them in schema
+            # order), checking each against the precomputed GPX_WPT_TAGS set;
+            # one join rather than quadratic += string growth
+            parts = [f'  <trkpt lat="{lat}" lon="{lon}">']
+            parts.extend(f"<{tag}>{val}</{tag}>"
+                         for tag, val in kwargs.items() if tag in GPX_WPT_TAGS)
+            parts.append("</trkpt>\n")
+            trkpnt = "".join(parts)
+
+        self._trkbuf.append(trkpnt)
+        self._mnbuf.append(trkpnt)
+
+    def write_gpx_tlr(self):
+        """
+        Write GPX track trailer tags and close file
+        """
+        self._trkbuf.append(get_trktlr())
+        self._trkbuf.append(get_gpxtlr())
+        self._trkfile.writelines(self._trkbuf) # no intermediate joined copy
+        self._trkfile.close()
+
+
+def convert_file(inpath):
+    """
+    Convert one day file to GPX. Runs in a worker process; all per-file
+    state lives on the tracker and its stack, so nothing leaks between
+    files and the return tuple is everything main() needs to stitch the
+    month file together and print the summaries in order.
+    """
+    tkr = NMEATracker(inpath, inpath.parent)
+    tkr.open()
+    bound_box = tkr.reader()
+    tkr.close()
+
+    stack = tkr._gpsstack
+    return (tkr.month_fragment(), bound_box, len(tkr._stash), stack.gaps,
+            tkr._glitches, stack.used_max)
+
+
+def main(indir, midsuffix, insuffix):
+    """
+    Main routine.
+    """
+    indir = Path(indir)
+    if not indir.is_dir():
+        print(f"Directory does not exist: '{INDIR}")
+        sys.exit(1)    
+
+    outdir = indir
+    print(f"NMEA datalog to GPX file converter ('{insuffix}' files in {indir})")
+
+    # Create the list of files to be processed in the order we want.
+    # glob does the double-suffix filtering in one pass, instead of iterdir
+    # plus two Python suffix tests per directory entry.
+    trips = []
+    infiles = sorted(indir.glob("*" + midsuffix + insuffix), key=lambda p: p.name.lower())
+    print(f"{len(infiles)} {midsuffix}{insuffix} files to convert to GPX")
+    
+    # Warm the NMEAReader parse caches (regex engine, msgID field lookups) once with a
+    # dummy sentence, so the first file in the batch doesn't pay the one-off compile cost.
+    NMEAReader.parse(b"$GPGGA,000000.000,3729.856,N,02327.091,E,1,12,1.0,0.0,M,0.0,M,,*66\r\n")
+
+    month_file = Path(indir) / f"{indir}.mnth.gpx"
+    print(f"Consolidate into {month_file}")
+    with open(month_file, "w", encoding="utf-8") as mnf:
+        mnf.write(get_header(f"{indir}/"))
+
+        # Convert the files in parallel, one worker process per core. Each file is
+        # independent; map() hands the results back in submission order so the month
+        # file is still stitched together sequentially. (Worker prints may interleave.)
+        all_gaps = []
+        all_glitches = []
+        stack_max = 0
+        with ProcessPoolExecutor() as pool:
+            for i, result in zip(infiles, pool.map(convert_file, infiles)):
+                fragment, bound_box, n_stash, gaps, glitches, smax = result
+                all_gaps.extend(gaps)
+                all_glitches.extend(glitches)
+                if smax > stack_max:
+                    stack_max = smax
+
+                mnf.write(get_trkhdr(i))
+                mnf.write(fragment)
+                mnf.write(get_trktlr())
+
+                if bound_box.diameter() > 0.1 * M_PER_NM : # 0.1 NM in metres
+                    trips.append((i.name, bound_box.diameter(),bound_box.diagonal_R(),bound_box.diagonal_L(),n_stash))
+
+                if n_stash:
+                    print(f"{n_stash} discarded NMEA sentences")
+                print("")
+
+        mnf.write(get_gpxtlr())
+ 
+    if all_glitches:
+        print(f"{len(all_glitches)} glitches:")
+        for g in all_glitches:
+            fn, gtext = g
+            print(f"{fn} {gtext}")
+    if all_gaps:
+        print(f"{len(all_gaps)} gaps:")
+        for g in all_gaps:
+            print(g)
+            
+
+            
+    # Print summary data in 'trips' for each file (i.e. each day) 
+    for t in trips:
+        name, diam, diag_R, diag_L, n_stash = t
+        print(f"{name} box: ~{diam/M_PER_NM:5.1f} NM {n_stash} discards") 
+    print(f"Finished all files, max stack used: {stack_max}")
+    
+
+
+
+if __name__ == "__main__":
+
+    INDIR = "/home/philip/gps/nmea_data/2024-06/"
+    MIDSUFFIX = ".day" # i.e. ".day.nmea"
+    INSUFFIX = ".nmea"
+    
+    if len(sys.argv) == 4:
+        INDIR = sys.argv[1]
+        MIDSUFFIX = sys.argv[2]
+        INSUFFIX = sys.argv[3]
+
+
+    if len(sys.argv) >4:
+        print(f"Either with no parameters or with nmea directory & suffix & midsuffix e.g.\n$ python nmeagpx.py /home/philip/gps/nmea_data/2024-05/ '.day' '.nmea'", flush=True)
+
+    main(INDIR, MIDSUFFIX, INSUFFIX)
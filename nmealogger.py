@@ -30,6 +30,7 @@ import sys
 import time as tm
 import pynmeagps.exceptions as nme
 
+from collections import deque
 from pathlib import Path
 from datetime import datetime, date
 from zoneinfo import ZoneInfo
@@ -54,12 +55,20 @@ totqk = 0
 
 HDOP_LIMIT = 3
 MAX_WAIT = 10 * 60 # 10 minutes in seconds
+MILESTONES = frozenset({0, 1000, 10000, 50000, 100000, 200000}) # memory-footprint report points
 LONG_ENOUGH = 300000 # Max messages before restart logs
 CURRENT_LOG = "current_log.txt"
 
 
 TZ = ZoneInfo('Europe/Athens')
 
+# sentence classes we drop before doing any per-field work. GSV (satellites
+# in view) dominates traffic; GSA is our only VDOP source but we don't use
+# it; VTG course-over-ground is instantaneous so useless for us. GLL/GNS are
+# NOT dropped: they carry real positions on some receivers.
+DROP_MSGIDS = frozenset({'GSV', 'GSA', 'VTG'})
+DROP_MSGIDS_B = frozenset({b'GSV', b'GSA', b'VTG'}) # same set, for the pre-parse reader filter
+
 class NewDay(Exception):
     """
     When the UTC day changes, which is about 3am Greek time in summer, 2am in winter
@@ -113,7 +122,9 @@ class Stack:
     """
     def __init__(self, max_size):
         self.max_size = max_size
-        self.items = []
+        self.items = deque() # O(1) popleft in first(); list.pop(0) shifts
+        self.besthdop = 99
+        self.bestraw = None
 
     def is_empty(self):
         return len(self.items) == 0
@@ -126,33 +137,82 @@ class Stack:
             print("Stack Overflow! Cannot add item.", flush=True)
         else:
             self.items.append(item)
+            raw, hdop = item
+            if hdop < self.besthdop: # running best: best() is then O(1)
+                self.besthdop = hdop
+                self.bestraw = raw
 
     def first(self, msg=None):
         if self.is_empty():
             print("Queue Underflow! Cannot remove item. {msg}", flush=True)
             return None
         else:
-            first = self.items.pop(0)
+            first = self.items.popleft()
             return first
 
     def flush(self):
-        self.items = []
+        self.items.clear()
+        self.besthdop = 99
+        self.bestraw = None
  
     def best(self):
-        # for (raw, hdop) tuple, return raw value with lowest HDOP
+        # the raw value with lowest HDOP, tracked as the items were pushed
         # this does not check that all the items are within a second or so, which it should
-        besthdop = 99
-        for i in self.items:
-            raw, hdop = i
-            if hdop < besthdop:
-                besthdop = hdop
-                bestnmea = raw
-        return bestnmea
+        return self.bestraw
 
 # Create a module-level instance of the Stack class which is unique, i.e. a singleton
 RUNNING_STACK = 6
 data_stack = Stack(RUNNING_STACK)
 
+FLUSH_BYTES = 64 * 1024 # batch this much before one real write()
+FLUSH_CHUNKS = 1000 # writev is limited to IOV_MAX (1024) segments per call
+FSYNC_SECS = 30 # like the kernel flusher: dirty data older than this hits the card
+
+class WriteBuffer:
+    """Batch the per-sentence writes into one gathered writev per FLUSH_BYTES.
+    On the router every little write() is a syscall against the SD card;
+    dozens of sentences per write is the single cheapest saving we can make.
+    The sentences are kept as the bytes objects the reader produced and
+    handed to writev as-is - no bytearray append copies in between.
+    write() returns True when it actually flushed, so the caller knows when
+    a did-the-file-really-grow check is worth doing.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.chunks = []
+        self.size = 0
+
+    def write(self, raw):
+        self.chunks.append(raw)
+        self.size += len(raw)
+        if self.size >= FLUSH_BYTES or len(self.chunks) >= FLUSH_CHUNKS:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self.chunks:
+            os.writev(self.f.fileno(), self.chunks)
+            self.chunks.clear()
+            self.size = 0
+
+    def sync(self):
+        # push the batch all the way to the SD card, not just to the kernel
+        self.flush()
+        os.fdatasync(self.f.fileno())
+
+_PAGE_KB = os.sysconf("SC_PAGESIZE") // 1024 if hasattr(os, "sysconf") else 4
+
+def memory_mb():
+    """Current resident set size in MB, from /proc/self/statm (one short
+    read, no task-accounting walk). Falls back to getrusage peak RSS
+    where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_KB / 1024.0
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF)[2] / 1024.0
+
 def print_summary(msg=None):
     global totcount, totgood, totparse, totqk,  start, msg_by_id
     
@@ -170,7 +230,7 @@ def print_summary(msg=None):
     else:
         pcent = totparse/totcount
 
-    print(f"{stamp} - Memory footprint: {resource.getrusage(resource.RUSAGE_SELF)[2] / 1024.0:.6f} MB  {msgcount:,d}  {msg}", flush=True)
+    print(f"{stamp} - Memory footprint: {memory_mb():.6f} MB  {msgcount:,d}  {msg}", flush=True)
     print(
     f"\n {totcount:,d} messages read in {secs:.2f} seconds ({secs/3600:.2f} hours)",
     f"\n {totgood:,d} messages with valid lat/lon logged,",
@@ -183,211 +243,263 @@ def print_summary(msg=None):
         print(f"   {id}  {msg_by_id[id]} parse errors",flush=True)
 
 def strim(nmealat):
-    """Strims off the ..667 or ..333 at the end of the string
-    we do not need this pointless and artificial precision"""
-    st = str(nmealat)
-    if len(st) < 13:
+    """Strims off the ..667 or ..333 recurring-decimal tail (from the
+    ddmm.mmmm -> degrees division) - we do not need this pointless and
+    artificial precision. Integer-space equivalent of the old
+    string-slice-and-reparse version: no str/float round trips."""
+    if not isinstance(nmealat, float):
+        return nmealat # empty field etc.
+    neg = nmealat < 0
+    n = round(-nmealat * 1e10) if neg else round(nmealat * 1e10)
+    q, r = divmod(n, 1000) # r = 10th..8th decimal digits
+    if r == 333:
+        trimmed = (n // 100) / 1e8 # ..333 -> ..3
+    elif r == 667:
+        trimmed = (q * 10 + 7) / 1e8 # ..667 -> ..7
+    else:
         return nmealat
-    
-    if st[10:] == "333":
-        st = st[:11]
-    if st[10:] == "667":
-        st = st[:10] + "7"
-    return float(st)
+    return -trimmed if neg else trimmed
     
 
-def parsestream(nmr, af, archivefilename, rawf, rawfilename):
+def parsestream(nmr, afbuf, archivefilename, rawbuf, rawfilename):
     """Runs indefinitely unless there is a parse error or interrupt when it produces an exception,
     but it seems to hang frequently.
     """
     global msgcount, msggood, msgparse, msgqk, data_stack, msg_by_id
     runcount = 0
     PREDATE_STACK = 20
+    TIME_EVERY = 64 # sentences between clock samples / periodic health checks
     AGED_FILE = 60 * 2 # 2 minutes
     NMR_DELAY = 0.5 # seconds when nmr iterator rus out of steam
     NMR_DELAYS = 50 # number of delays allowed before termination
 
     pre_date_stack = Stack(PREDATE_STACK)
+    have_date = False # no 'thisday' yet: a real flag, not a locals() probe
+    thisday = None
+    lastday = None
+    time_tick = TIME_EVERY # force a sample on the first sentence
     
     poor_data = Bad_stash()
-    got_data_at = tm.time()
+    got_data_at = tm.monotonic() # interval clock: immune to NTP/RTC steps
+    last_fsync = got_data_at
+    mono_time = got_data_at
+    pre_time = tm.time()
+
+    # count in fast locals - a global store per sentence is interpreter
+    # slow path - and reconcile to the module counters on any exit
+    _msgcount = msgcount
+    _msggood = msggood
+    _msgparse = msgparse
+    _msgqk = msgqk
     # print(f"== Restarted parsestream")
     
-    while True: # to cope with parse exception breaking the infinite generator
-        try:
-            # nmr_delays = 0 # this caused crashes? Or do I just need to rebiit router??
-            for (raw, parsed_data) in nmr: # nmr is an infinite iterator - or is meant to be !
-                nmr_delays = 0
-                runcount +=1
+    try:
+        while True: # to cope with parse exception breaking the infinite generator
+            try:
+                # nmr_delays = 0 # this caused crashes? Or do I just need to rebiit router??
+                for (raw, parsed_data) in nmr: # nmr is an infinite iterator - or is meant to be !
+                    nmr_delays = 0
+                    runcount +=1
                 
-                # if runcount == 1:
-                    # # throw away the first sentence as it is from the previous run, not cleaned out by exception.
-                    # continue
+                    # if runcount == 1:
+                        # # throw away the first sentence as it is from the previous run, not cleaned out by exception.
+                        # continue
  
-                if msgcount > LONG_ENOUGH - 1:
-                    raise NewLogs
-                    
-                if not archivefilename.is_file():
-                    raise FileNotFoundError( errno.ENOENT, os.strerror(errno.ENOENT), archivefilename)
-                if not rawfilename.is_file():
-                    raise FileNotFoundError( errno.ENOENT, os.strerror(errno.ENOENT), rawfilename)
+                    if _msgcount > LONG_ENOUGH - 1:
+                        raise NewLogs
                     
-                pre_size = rawfilename.stat()
-                pre_mod_time = rawfilename.stat().st_mtime # modification time - check if process hung somehow
-                pre_time = tm.time()
+                    # the health checks below only need coarse time, so sample the
+                    # clock (and stat the files) once every TIME_EVERY sentences:
+                    # at ~5 sentences/s that is every dozen seconds or so, ample
+                    # resolution for thresholds measured in minutes
+                    time_tick += 1
+                    if time_tick >= TIME_EVERY:
+                        time_tick = 0
+                        if not archivefilename.is_file():
+                            raise FileNotFoundError( errno.ENOENT, os.strerror(errno.ENOENT), archivefilename)
+                        if not rawfilename.is_file():
+                            raise FileNotFoundError( errno.ENOENT, os.strerror(errno.ENOENT), rawfilename)
+
+                        pre_stat = rawfilename.stat() # one stat: size and mtime both come from it
+                        pre_size = pre_stat.st_size
+                        pre_mod_time = pre_stat.st_mtime # modification time - check if process hung somehow
+                        pre_time = tm.time()
+                        mono_time = tm.monotonic() # for the interval clocks below
+
+                        # This is to check for hung process, but it never gets triggered. Hang must be somewhere else.. inside nmr ?
+                        since = pre_time - pre_mod_time
+                        if  since > 2 * AGED_FILE:
+                            msgcount, msggood, msgparse, msgqk = _msgcount, _msggood, _msgparse, _msgqk
+                            print_summary(f"\n__ Very long time since last {rawfilename.name} modification: {since/60:.2f} minutes")        
+                        elif  since > AGED_FILE:
+                            print(f"_  Long time since last {rawfilename.name} modification: {since/60:.2f} minutes")    
+
+                        # durability is time-based, not per-write: anything between
+                        # syncs can be lost on a power cut, but never more than
+                        # FSYNC_SECS worth - and we don't pay fsync per sentence
+                        if mono_time - last_fsync > FSYNC_SECS:
+                            afbuf.sync()
+                            rawbuf.sync()
+                            last_fsync = mono_time
                 
-                # This is to check for hung process, but it never gets triggered. Hang must be somewhere else.. inside nmr ?
-                since = pre_time - pre_mod_time
-                if  since > 2 * AGED_FILE:
-                    print_summary(f"\n__ Very long time since last {rawfilename.name} modification: {since/60:.2f} minutes")        
-                elif  since > AGED_FILE:
-                    print(f"_  Long time since last {rawfilename.name} modification: {since/60:.2f} minutes")    
-                    
-            
-                if not parsed_data:
-                    # skip unparseable, even if there is no exception thrown - happens when QK butts in.
-                    # Hmm. this is not working...
-                    try:
-                        if "Quark-elec:No valid AIS signal." in raw.decode("utf-8", "strict"):
-                            print(f"Quark-elec corruption (utf8):",raw.decode("utf-8", "strict"), flush=True)
-                            msgqk += 1
+
+                    if parsed_data is None:
+                        # skip unparseable, even if there is no exception thrown - happens when QK butts in.
+                        # Hmm. this is not working...
+                        if b"Quark-elec:No valid AIS signal." in raw:
+                            # bytes membership: no decode needed to recognise the QK marker
+                            print(f"Quark-elec corruption:",raw, flush=True)
+                            _msgqk += 1
                         else:
-                            print(f"Unparsed data (utf8):",raw.decode("utf-8", "strict"), flush=True)
-                    except:
-                        print(f"Unparsed data: (binary)",raw, flush=True)
-                        msgparse += 1
-                    continue
-                else:
-                    d = parsed_data.__dict__
+                            try:
+                                print(f"Unparsed data (utf8):",raw.decode("utf-8", "strict"), flush=True)
+                            except UnicodeDecodeError:
+                                print(f"Unparsed data: (binary)",raw, flush=True)
+                                _msgparse += 1
+                        continue
+
+                    msgID = parsed_data.msgID # fetched once; every branch below keys on it
+                    if msgID in DROP_MSGIDS:
+                        # reject the bulk of the stream with one set-membership
+                        # test before any field probing
+                        _msgcount += 1
+                        continue
+
+                    # one bound get, then a single hash probe per field we care
+                    # about - instead of the old 'x' in d / d['x'] double lookups
+                    dget = parsed_data.__dict__.get
+                    mlat = dget('lat')
+                    mlon = dget('lon')
+                    mhdop = dget('HDOP') # HDOP does not imply lat/lon, GPGSA gives HDOP too
                 
-                # GSV is the number of satellites in view.. drop
-                # GSA gives PDOP as well as HDOP and VDOP, but we don't need it. This is the only source for VDOP
-                # VTG is course over ground, but this is instantaneous so useless for us.
+                    # GSV is the number of satellites in view.. drop
+                    # GSA gives PDOP as well as HDOP and VDOP, but we don't need it. This is the only source for VDOP
+                    # VTG is course over ground, but this is instantaneous so useless for us.
                     
-                # We need RMC for the date. Others only give time. 
-                # Sometimes the RMC sentence is corrupted, but still has valid checksum, so date is invalid.
-                if 'date' in d and d['date'] != "":
-                    if 'thisday' not in locals(): # first date seen in this run of parsestream
-                        thisday = d['date']
-                        lastday = thisday
-                        print(f"++ Set today's date {thisday} '{len(pre_date_stack.items)}' lat/lon items in pre_date queue", flush=True)
-                        af.write(raw) # write the date line to the filtered archive just the once
-                        af.flush()
-                        good_data_at = tm.time()
+                    # We need RMC for the date. Others only give time. 
+                    # Sometimes the RMC sentence is corrupted, but still has valid checksum, so date is invalid.
+                    # only RMC carries a date, so no other class need even probe for one
+                    if msgID == 'RMC' and (msgdate := dget('date', "")) != "":
+                        if not have_date: # first date seen in this run of parsestream
+                            have_date = True
+                            thisday = msgdate
+                            lastday = thisday
+                            print(f"++ Set today's date {thisday} '{len(pre_date_stack.items)}' lat/lon items in pre_date queue", flush=True)
+                            afbuf.write(raw) # write the date line to the filtered archive just the once
+                            good_data_at = tm.time()
                         
-                        if not pre_date_stack.is_empty():
-                            while not pre_date_stack.is_empty():
-                                i_raw, i_hdop = pre_date_stack.first(msg="pre_date items")
-                                # but just throw them away
-                                print(">> ",i_raw.decode("utf-8", "strict"), end="")
-                            print(f"-- over {tm.time() - pre_time:.4f} seconds")
-                    else:
-                        thisday = d['date']   
-                        if thisday != lastday: # happens at UTC, i.e. 0300 Europe/Athens timezone.
-                            # print("++ NEXT DAY", flush=True)
-                            pre_date_stack.flush()
-                            raise NewDay
+                            if not pre_date_stack.is_empty():
+                                while not pre_date_stack.is_empty():
+                                    i_raw, i_hdop = pre_date_stack.first(msg="pre_date items")
+                                    # but just throw them away
+                                    print(">> ",i_raw.decode("utf-8", "strict"), end="")
+                                print(f"-- over {tm.time() - pre_time:.4f} seconds")
+                        else:
+                            thisday = msgdate
+                            if thisday != lastday: # happens at UTC, i.e. 0300 Europe/Athens timezone.
+                                # print("++ NEXT DAY", flush=True)
+                                pre_date_stack.flush()
+                                raise NewDay
                             
-                if 'time' in d:
-                    t = d['time']
-                else: 
-                    t = 0
+                    t = dget('time', 0)
                                    
-                if 'thisday' not in locals(): # ie first time since restart
-                    stamp = datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')
-                    # print(f"{stamp} -- {parsed_data.msgID} No date yet... (utf8):",raw.decode("utf-8", "strict")[:-2], flush=True)
-                    if 'lat' in d and 'lon' in d and 'HDOP' in d: # note HDOP does not mean there is a lat/lon, GPGSA gives HDOP too.
-                        pre_date_stack.push((raw, float(d['HDOP'])))
-                        # print(f"{parsed_data.msgID}  {t} pre_date ADD", flush=True)
-                        if pre_date_stack.is_full():
-                            print(f"{stamp} -- {parsed_data.msgID} pre_date queue full. Flushing..|", flush=True)
-                            pre_date_stack.flush()
-                    continue # next NMEA sentence..
+                    if not have_date: # ie first time since restart
+                        # print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} -- {msgID} No date yet... (utf8):",raw.decode("utf-8", "strict")[:-2], flush=True)
+                        if mlat is not None and mlon is not None and mhdop is not None:
+                            pre_date_stack.push((raw, float(mhdop))) # pre-date only: not worth sharing hdop_f
+                            # print(f"{msgID}  {t} pre_date ADD", flush=True)
+                            if pre_date_stack.is_full():
+                                # the stamp is only for this (rare) print: format it here, not per sentence
+                                stamp = datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')
+                                print(f"{stamp} -- {msgID} pre_date queue full. Flushing..|", flush=True)
+                                pre_date_stack.flush()
+                        continue # next NMEA sentence..
 
                         
                     
-                if 'HDOP' not in d:
-                    hdop = ""
-                else:
-                    hdop = f"{float(d['HDOP']):4.2f}"
-
-                if 'lat' in d and 'lon' in d:
-                    lat = strim(d['lat'])    
-                    lon = strim(d['lon'])
-                    if 'HDOP' in d:
-                        if float(d['HDOP']) > HDOP_LIMIT or lat =="":
-                            print(f"{parsed_data.msgID}  {thisday} {t} UTC  {lat=:<13} {lon=:<13} {hdop=} {d['HDOP']}", flush=True) # last 2 digits always 33 or 67. They are strings.
-                    if lat != "":
-                        rawf.write(raw)
-                        rawf.flush()
-                        post_size = rawfilename.stat()
-                        if post_size <= pre_size:
-                            print(f"{parsed_data.msgID}  {thisday} {t} UTC  - FAILED TO UPDATE RAW FILE, aborting.. ", flush=True) 
-                            pre_date_stack.flush()
-                            raise NewDay
-
-                        if 'HDOP' in d:
-                            if float(d['HDOP']) >= HDOP_LIMIT: # rather crude.. 
-                                poor_data.put(raw, parsed_data, float(d['HDOP']), lat, lon, t)
-                            else:
-                                # TO DO
-                                # a 6-deep queue and ideally, calc average, weighted by HDOP.. hang on, this is actually a bit tricky...
-                                # just pick the best out of the 6 then.
+                    # one float conversion, and no f-string until a print needs one
+                    hdop_f = None if mhdop is None else float(mhdop)
+
+                    if mlat is not None and mlon is not None:
+                        lat = strim(mlat)    
+                        lon = strim(mlon)
+                        if hdop_f is not None:
+                            if hdop_f > HDOP_LIMIT or lat =="":
+                                hdop = f"{hdop_f:4.2f}"
+                                print(f"{msgID}  {thisday} {t} UTC  {lat=:<13} {lon=:<13} {hdop=} {mhdop}", flush=True) # last 2 digits always 33 or 67. They are strings.
+                        if lat != "":
+                            if rawbuf.write(raw): # only a real write can grow the file
+                                post_size = rawfilename.stat().st_size
+                                if post_size <= pre_size: # sizes, not whole stat tuples
+                                    print(f"{msgID}  {thisday} {t} UTC  - FAILED TO UPDATE RAW FILE, aborting.. ", flush=True) 
+                                    pre_date_stack.flush()
+                                    raise NewDay
+
+                            if hdop_f is not None:
+                                if hdop_f >= HDOP_LIMIT: # rather crude.. 
+                                    poor_data.put(raw, parsed_data, hdop_f, lat, lon, t)
+                                else:
+                                    # TO DO
+                                    # a 6-deep queue and ideally, calc average, weighted by HDOP.. hang on, this is actually a bit tricky...
+                                    # just pick the best out of the 6 then.
                                 
-                                # TO DO : CHECK that these data points are all within a second or two ! Otherwise we throw away data we need.
+                                    # TO DO : CHECK that these data points are all within a second or two ! Otherwise we throw away data we need.
                                 
-                                # Push data to the stack
-                                data_stack.push((raw, float(d['HDOP'])))
-                                if data_stack.is_full():
-                                    af.write(data_stack.best())
-                                    af.flush()
-                                    data_stack.flush()
-                                    got_data_at = tm.time()
-                                    msggood += 1
+                                    # Push data to the stack
+                                    data_stack.push((raw, hdop_f))
+                                    if data_stack.is_full():
+                                        afbuf.write(data_stack.best())
+                                        data_stack.flush()
+                                        got_data_at = tm.monotonic()
+                                        _msggood += 1
                                 
                                 
-                        now = tm.time()
-                        if now - got_data_at > MAX_WAIT: # seconds
-                            # Add to log anyway, even if bad quality data
-                            # should write an extra log file about these..
-                            if poor_data.is_available():
-                                poor_raw, poor_parsed_data, poor_hdop, poor_lat, poor_lon, poor_t = poor_data.get()
-                                af.write(poor_raw)
-                                af.flush()
-                                print(f"{poor_parsed_data.msgID}  {thisday} {poor_t} {poor_lat=:<13} {poor_lon=:<13} {poor_hdop=} POOR DATA BUT USING ANYWAY AS TIMEOUT") 
-                                poor_data.flush()
-                                got_data_at = tm.time()
-                            else:
-                                print(f"Empty poor data stash.  {thisday} computer time: {now} TIMEOUT but not even poor data available") 
-                            got_data_at = tm.time()
-                    else:
-                            lat = 0
-                            lon = 0
-
-                if msgcount in [0, 1000, 10000, 50000, 100000, 200000]: 
-                    print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} - Memory footprint: {resource.getrusage(resource.RUSAGE_SELF)[2] / 1024.0:.6f} MB  {msgcount:,d}", flush=True)
-                msgcount += 1            
-                # if msgcount % 100000 == 0: 
-                    # print_summary(msg="")
+                            now = mono_time # coarse sample is plenty against a 10-minute limit
+                            if now - got_data_at > MAX_WAIT: # seconds
+                                # Add to log anyway, even if bad quality data
+                                # should write an extra log file about these..
+                                if poor_data.is_available():
+                                    poor_raw, poor_parsed_data, poor_hdop, poor_lat, poor_lon, poor_t = poor_data.get()
+                                    afbuf.write(poor_raw)
+                                    print(f"{poor_parsed_data.msgID}  {thisday} {poor_t} {poor_lat=:<13} {poor_lon=:<13} {poor_hdop=} POOR DATA BUT USING ANYWAY AS TIMEOUT") 
+                                    poor_data.flush()
+                                    got_data_at = tm.monotonic()
+                                else:
+                                    print(f"Empty poor data stash.  {thisday} computer time: {pre_time} TIMEOUT but not even poor data available") 
+                                got_data_at = tm.monotonic()
+                        else:
+                                lat = 0
+                                lon = 0
+
+                    if _msgcount in MILESTONES:
+                        print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} - Memory footprint: {memory_mb():.6f} MB  {_msgcount:,d}", flush=True)
+                    _msgcount += 1            
+                    # if msgcount % 100000 == 0: 
+                        # print_summary(msg="")
                     
-            nmr_delays += 1
-            #print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ~~ No more data in iterator 'nmr' {nmr_delays}. This should never happen.")
-            tm.sleep(NMR_DELAY)
-            if nmr_delays >= NMR_DELAYS:
-                print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ~~ {NMR_DELAYS*NMR_DELAY} seconds since nmr iterator response. {nmr_delays} tries. Aborting. ")
-                sys.exit(1)
+                nmr_delays += 1
+                #print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ~~ No more data in iterator 'nmr' {nmr_delays}. This should never happen.")
+                tm.sleep(NMR_DELAY)
+                if nmr_delays >= NMR_DELAYS:
+                    print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ~~ {NMR_DELAYS*NMR_DELAY} seconds since nmr iterator response. {nmr_delays} tries. Aborting. ")
+                    sys.exit(1)
                     
-        except nme.NMEAParseError as e:
+            except nme.NMEAParseError as e:
             
-            # print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} Parse EXCEPTION in parsestream\n {e}", flush=True)
-            # if 'raw' in locals(): # this is probably not the correct one for this error!
-                # print(f"raw:{raw}", flush=True)
-            if parsed_data.msgID not in msg_by_id:
-                msg_by_id[parsed_data.msgID] = 0
-            msg_by_id[parsed_data.msgID] += 1
-            msgparse += 1
-            # clears exception so calling routine just continues its while True loop
-            pre_date_stack.flush()
+                # print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} Parse EXCEPTION in parsestream\n {e}", flush=True)
+                # if 'raw' in locals(): # this is probably not the correct one for this error!
+                    # print(f"raw:{raw}", flush=True)
+                if parsed_data.msgID not in msg_by_id:
+                    msg_by_id[parsed_data.msgID] = 0
+                msg_by_id[parsed_data.msgID] += 1
+                _msgparse += 1
+                # clears exception so calling routine just continues its while True loop
+                pre_date_stack.flush()
+    finally:
+        msgcount = _msgcount
+        msggood = _msggood
+        msgparse = _msgparse
+        msgqk = _msgqk
 
     print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ~~ Dropped off end of parsestream function. This should not happen as it is in a while True loop.")
 
@@ -408,18 +520,20 @@ def readstream(stream: socket.socket):
     nmr = NMEAReader(
         stream,
         quitonerror = ERR_RAISE,
+        msgdrop = DROP_MSGIDS_B, # dropped classes never reach the parser at all
     )
-    file_bufsize = 1024
+    file_bufsize = 128 * 1024
     
     # nmea_data gets rsync'd to server, nmea_rawd does not.
+    month = start.strftime('%Y-%m') # one strftime; both dirs must agree on the month
     parentdir = Path(__file__).parent.parent
-    archivedir = parentdir / Path("nmea_data") / Path(start.strftime('%Y-%m'))
+    archivedir = parentdir / "nmea_data" / month # '/' takes plain strings; no throwaway Path objects
     archivedir.mkdir(parents=True, exist_ok=True)
  
-    rawdir = parentdir / Path("nmea_rawd") / Path(start.strftime('%Y-%m'))
+    rawdir = parentdir / "nmea_rawd" / month
     rawdir.mkdir(parents=True, exist_ok=True)
     
-    currentdir = parentdir / Path("nmea_data")
+    current_log = parentdir / "nmea_data" / CURRENT_LOG # constant across rotations
  
     while True:  # when parse errors caused this to restart, this was sensible. But now all exceptions terminate except NewDay.
         msgcount = 0
@@ -432,22 +546,36 @@ def readstream(stream: socket.socket):
             fnstem = newstart.strftime('%Y-%m-%d_%H%M')
             archivefilename = archivedir / (fnstem +".nmea")
             rawfilename = rawdir / (fnstem +".nmea")
-            
-            current_log = currentdir / Path(CURRENT_LOG)
-                
+
             print(f"Writing\n {archivefilename}\n {rawfilename}", flush=True)
             with open(current_log, 'w', buffering=file_bufsize) as fnf: 
                 fnf.write(f"{fnstem}.nmea")
 
-            with open(archivefilename, 'ab', buffering=file_bufsize) as af: # ab not wr just in case the filename is unchanged.. 
-                with open(rawfilename, 'ab', buffering=file_bufsize) as rawf: # ab not wr just in case the filename is unchanged.. 
-                    while True:
-                        try:
-                            parsestream(nmr, af, archivefilename, rawf, rawfilename)
-                        except nme.NMEAParseError as e:
-                            print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ParseError EXCEPTION caught OUTSIDE parsestream\n {e}", flush=True)
-                            msgparse += 1
-                            continue
+            # unbuffered: WriteBuffer does all the batching, so each flush is
+            # one straight write() syscall with no BufferedWriter lock/copy
+            with open(archivefilename, 'ab', buffering=0) as af: # ab not wr just in case the filename is unchanged.. 
+                with open(rawfilename, 'ab', buffering=0) as rawf: # ab not wr just in case the filename is unchanged.. 
+                    afbuf = WriteBuffer(af)
+                    rawbuf = WriteBuffer(rawf)
+                    try:
+                        while True:
+                            try:
+                                parsestream(nmr, afbuf, archivefilename, rawbuf, rawfilename)
+                            except nme.NMEAParseError as e:
+                                print(f"{datetime.now(tz=TZ).strftime('%Y-%m-%d %H:%M %Z')} ParseError EXCEPTION caught OUTSIDE parsestream\n {e}", flush=True)
+                                msgparse += 1
+                                continue
+                    finally:
+                        # whatever takes us out (NewDay, interrupt, crash),
+                        # the batched sentences reach the files first
+                        afbuf.flush()
+                        rawbuf.flush()
+                        # rotated logs are never read back by this process:
+                        # let the kernel drop their page cache rather than
+                        # squeeze the router's small memory (no-op elsewhere)
+                        if hasattr(os, "posix_fadvise"):
+                            os.posix_fadvise(af.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                            os.posix_fadvise(rawf.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
         except NewDay:
             # this is bad style. Really a GOTO statement.
             print_summary("-- Next Day - restart logfiles")
@@ -466,7 +594,11 @@ def readstream(stream: socket.socket):
             # This was raised explicitly in parsestream
             print_summary(f"FileNotFound error: {archivefilename}  or  {rawfilename}, restarting with new file.\n {e}")
             break
-        except Exception as e: 
+        except socket.timeout:
+            # the bounded read fired: nothing readable for MAX_WAIT seconds
+            print_summary(f"No data from socket for {MAX_WAIT} seconds - stream is dead. Exiting.")
+            break
+        except Exception as e:
             print_summary(f"generic EXCEPTION\n {e}")
             raise e
             break
@@ -479,6 +611,7 @@ if __name__ == "__main__":
     PORT = 2000
     max_tries = 200
     socket_delay = 0.1 # seconds
+    SOCKET_TIMEOUT = 5 # seconds per connect attempt
     
     if len(sys.argv) == 3:
         SERVER = sys.argv[1]
@@ -492,6 +625,20 @@ if __name__ == "__main__":
     
     print(f"Opening socket {SERVER}:{PORT}...", flush=True)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # a roomy kernel receive buffer rides out NMEA bursts from the QK
+        # while we are busy writing to the SD card; must be set before
+        # connect() so the TCP window is negotiated accordingly
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+        # keepalives make a dead peer (GPS mux power-cycled, wifi dropped)
+        # surface as a socket error instead of an indefinitely silent recv
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"): # Linux; absent on some platforms
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+        # bound each connect attempt: a dead/unroutable server fails in
+        # SOCKET_TIMEOUT seconds instead of hanging for the kernel default
+        sock.settimeout(SOCKET_TIMEOUT)
         tries = 1
         while True:
             try:
@@ -507,4 +654,8 @@ if __name__ == "__main__":
                 tm.sleep(socket_delay)
 
                 continue
+        # a read timeout instead of fully blocking: if the kernel socket
+        # wedges (the mystery hang inside the nmr iterator), recv raises
+        # socket.timeout after MAX_WAIT rather than stalling forever
+        sock.settimeout(MAX_WAIT)
         readstream(sock)
\ No newline at end of file
@@ -51,6 +51,7 @@ class NMEAReader:
         quitonerror: int = ERR_LOG,
         bufsize: int = 4096,
         errorhandler: object = None,
+        msgdrop: frozenset = None,
     ):
         """Constructor.
 
@@ -61,6 +62,8 @@ class NMEAReader:
         :param int quitonerror: 0 = ignore, 1 = log and continue, 2 = (re)raise (1)
         :param int bufsize: socket recv buffer size (4096)
         :param object errorhandler: error handling object or function (None)
+        :param frozenset msgdrop: 3-byte msgIDs (e.g. b"GSV") to discard before
+            parsing; dropped sentences are never returned (None)
         :raises: NMEAParseError (if mode is invalid)
         """
         # pylint: disable=too-many-arguments
@@ -78,6 +81,7 @@ class NMEAReader:
         self._nmea_only = nmeaonly
         self._validate = validate
         self._mode = msgmode
+        self._msgdrop = msgdrop
 
     def __iter__(self):
         """Iterator."""
@@ -123,6 +127,11 @@ class NMEAReader:
                 if bytehdr in NMEA_HDR:  # it's a NMEA message
                     byten = self._read_line()  # NMEA protocol is CRLF terminated
                     raw_data = bytehdr + byten
+                    if (
+                        self._msgdrop is not None
+                        and raw_data[3:6] in self._msgdrop
+                    ):  # unwanted msgID, discard before parsing
+                        continue
                     parsed_data = self.parse(
                         raw_data, validate=self._validate, msgmode=self._mode
                     )
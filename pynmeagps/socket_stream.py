@@ -79,9 +79,9 @@ class SocketStream:
         while len(self._buffer) < num:
             if not self._recv():
                 return b""
-        data = self._buffer[:num]
-        self._buffer = self._buffer[num:]
-        return bytes(data)
+        data = bytes(self._buffer[:num])
+        del self._buffer[:num]  # in-place trim, no remainder copy
+        return data
 
     def readline(self) -> bytes:
         """
@@ -92,16 +92,18 @@ class SocketStream:
         :rtype: bytes
         """
 
-        line = b""
-        while True:
-            data = self.read(1)
-            if len(data) == 1:
-                line += data
-                if line[-1:] == b"\n":  # LF
-                    break
-            else:
-                break
-
+        # locate the LF in the buffered data (C-speed scan), topping up
+        # from the socket as needed, then slice the line out in one go
+        idx = self._buffer.find(b"\n")
+        while idx == -1:
+            scanned = len(self._buffer)  # rescan new bytes only
+            if not self._recv():  # EOF - return any partial line
+                line = bytes(self._buffer)
+                self._buffer.clear()
+                return line
+            idx = self._buffer.find(b"\n", scanned)
+        line = bytes(self._buffer[: idx + 1])
+        del self._buffer[: idx + 1]
         return line
 
     def write(self, data: bytes, **kwargs):